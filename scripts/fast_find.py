@@ -3,18 +3,200 @@ import math
 import requests
 from PIL import Image, ImageDraw
 import io
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import numpy as np
 from sklearn.cluster import DBSCAN
 import cv2
 import concurrent.futures
 import time
+import os
+import hashlib
+import sqlite3
+
+class JobManifest:
+    """SQLite-backed record of per-village job status for resumable batch runs"""
+
+    def __init__(self, db_file: str):
+        self.conn = sqlite3.connect(db_file)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                village_id TEXT PRIMARY KEY,
+                geojson_file TEXT NOT NULL,
+                inputs_hash TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                started_at REAL,
+                finished_at REAL,
+                duration REAL,
+                outputs TEXT,
+                error TEXT
+            )
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def hash_inputs(geojson_file: str, zoom: int) -> str:
+        """Hash the village boundary file together with the run parameters"""
+        digest = hashlib.sha256()
+        with open(geojson_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        digest.update(f"zoom={zoom}".encode())
+        return digest.hexdigest()
+
+    def get(self, village_id: str) -> Optional[dict]:
+        """Return the job row for a village, or None if it has never run"""
+        row = self.conn.execute("SELECT * FROM jobs WHERE village_id = ?", (village_id,)).fetchone()
+        return dict(row) if row else None
+
+    def reset(self, village_id: str):
+        """Forget a village's history, e.g. when its inputs have changed"""
+        self.conn.execute("DELETE FROM jobs WHERE village_id = ?", (village_id,))
+        self.conn.commit()
+
+    def start(self, village_id: str, geojson_file: str, inputs_hash: str) -> int:
+        """Mark a village as running and return its attempt number"""
+        self.conn.execute("""
+            INSERT INTO jobs (village_id, geojson_file, inputs_hash, status, attempts, started_at)
+            VALUES (?, ?, ?, 'running', 1, ?)
+            ON CONFLICT(village_id) DO UPDATE SET
+                geojson_file = excluded.geojson_file,
+                inputs_hash = excluded.inputs_hash,
+                status = 'running',
+                attempts = attempts + 1,
+                started_at = excluded.started_at,
+                finished_at = NULL,
+                duration = NULL,
+                error = NULL
+        """, (village_id, geojson_file, inputs_hash, time.time()))
+        self.conn.commit()
+        return self.get(village_id)['attempts']
+
+    def finish(self, village_id: str, status: str, duration: float,
+               outputs: Optional[dict] = None, error: Optional[str] = None):
+        """Record the outcome of the current attempt for a village"""
+        self.conn.execute("""
+            UPDATE jobs SET status = ?, finished_at = ?, duration = ?, outputs = ?, error = ?
+            WHERE village_id = ?
+        """, (status, time.time(), duration, json.dumps(outputs) if outputs else None, error, village_id))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def _concat_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenate arange(start, start + count) for each start/count pair"""
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    run_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return np.repeat(starts - run_starts, counts) + np.arange(total)
+
+class PolygonCollection:
+    """Array-backed set of polygons: flat [lon, lat] buffer plus ring/part offsets.
+
+    Rings of polygon i are ring_offsets indices geom_offsets[i]..geom_offsets[i + 1],
+    the first being the exterior. Rings are stored closed, as in GeoJSON.
+    """
+
+    ATTRIBUTE_DTYPE = np.dtype([
+        ('id', np.int32),
+        ('area_pixels', np.int64),
+        ('within_village', np.bool_)
+    ])
+
+    def __init__(self, coords: np.ndarray, ring_offsets: np.ndarray,
+                 geom_offsets: np.ndarray, attributes: np.ndarray):
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.geom_offsets = geom_offsets
+        self.attributes = attributes
+
+    @classmethod
+    def from_rings(cls, rings: List[np.ndarray], attributes: np.ndarray) -> 'PolygonCollection':
+        """Build a collection of single-ring polygons from closed (N, 2) rings"""
+        lengths = np.array([len(ring) for ring in rings], dtype=np.int64)
+        ring_offsets = np.concatenate(([0], np.cumsum(lengths)))
+        geom_offsets = np.arange(len(rings) + 1, dtype=np.int64)
+        coords = np.concatenate(rings) if rings else np.zeros((0, 2), dtype=np.float64)
+        return cls(coords, ring_offsets, geom_offsets, attributes)
+
+    def __len__(self) -> int:
+        return len(self.attributes)
+
+    def exterior(self, i: int) -> np.ndarray:
+        """Closed exterior ring of polygon i (a view into the coordinate buffer)"""
+        ring = self.geom_offsets[i]
+        return self.coords[self.ring_offsets[ring]:self.ring_offsets[ring + 1]]
+
+    def _exterior_reduce(self, ufunc) -> np.ndarray:
+        """Apply a ufunc reduction over each exterior ring's coordinates"""
+        if len(self) == 0:
+            return np.zeros((0, 2), dtype=np.float64)
+        per_ring = ufunc.reduceat(self.coords, self.ring_offsets[:-1], axis=0)
+        return per_ring[self.geom_offsets[:-1]]
+
+    def exterior_bounds(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Per-polygon (min_lon, min_lat) and (max_lon, max_lat) of the exterior ring"""
+        return self._exterior_reduce(np.minimum), self._exterior_reduce(np.maximum)
+
+    def exterior_means(self) -> np.ndarray:
+        """Per-polygon mean [lon, lat] of the exterior ring, closing point included"""
+        exterior_rings = self.geom_offsets[:-1]
+        counts = self.ring_offsets[exterior_rings + 1] - self.ring_offsets[exterior_rings]
+        return self._exterior_reduce(np.add) / np.maximum(counts, 1)[:, None]
+
+    def take(self, indices) -> 'PolygonCollection':
+        """Return a new collection holding only the given polygons"""
+        indices = np.asarray(indices, dtype=np.int64)
+        ring_starts = self.geom_offsets[indices]
+        ring_counts = self.geom_offsets[indices + 1] - ring_starts
+        rings = _concat_ranges(ring_starts, ring_counts)
+
+        coord_starts = self.ring_offsets[rings]
+        coord_counts = self.ring_offsets[rings + 1] - coord_starts
+        coords = self.coords[_concat_ranges(coord_starts, coord_counts)]
+
+        ring_offsets = np.concatenate(([0], np.cumsum(coord_counts)))
+        geom_offsets = np.concatenate(([0], np.cumsum(ring_counts)))
+        return PolygonCollection(coords, ring_offsets, geom_offsets, self.attributes[indices].copy())
+
+    def to_geojson(self, static_properties: dict = None) -> List[dict]:
+        """Convert to a list of GeoJSON Features (only needed when writing output)"""
+        static_properties = static_properties or {}
+        features = []
+        for i in range(len(self)):
+            rings = [
+                self.coords[self.ring_offsets[r]:self.ring_offsets[r + 1]].tolist()
+                for r in range(self.geom_offsets[i], self.geom_offsets[i + 1])
+            ]
+            attrs = self.attributes[i]
+            properties = {
+                "id": int(attrs['id']),
+                **static_properties,
+                "area_pixels": int(attrs['area_pixels']),
+                "coordinate_count": len(rings[0])
+            }
+            if attrs['within_village']:
+                properties["within_village"] = True
+            features.append({
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": rings
+                },
+                "properties": properties
+            })
+        return features
 
 class VillageMapCropper:
-    def __init__(self, max_workers=8):
+    def __init__(self, max_workers=8, strict_downloads=False):
         # OpenStreetMap tile server (free to use)
         self.tile_server = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
         self.max_workers = max_workers
+        # Raise on tile download errors instead of substituting a blank tile
+        self.strict_downloads = strict_downloads
         self.session = requests.Session()  # Reuse connection
         
         # Add headers to avoid rate limiting
@@ -74,6 +256,8 @@ class VillageMapCropper:
             return Image.open(io.BytesIO(response.content))
         except Exception as e:
             print(f"Error downloading tile {x}/{y}/{z}: {e}")
+            if self.strict_downloads:
+                raise
             # Return a blank tile if download fails
             return Image.new('RGB', (256, 256), color='lightgray')
     
@@ -122,9 +306,19 @@ class VillageMapCropper:
         
         return lat, lon
     
+    def pixels_to_lonlat(self, pixels: np.ndarray, zoom: int,
+                         min_tile_x: int, min_tile_y: int) -> np.ndarray:
+        """Vectorized pixel_to_latlon for an (N, 2) array of pixels, returning [lon, lat] rows"""
+        n = 2.0 ** zoom
+        tile_x_exact = min_tile_x + pixels[:, 0] / 256.0
+        tile_y_exact = min_tile_y + pixels[:, 1] / 256.0
+        lon = tile_x_exact / n * 360.0 - 180.0
+        lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * tile_y_exact / n))))
+        return np.column_stack((lon, lat))
+    
     def detect_blue_polygons(self, image: Image.Image, zoom: int,
-                           min_tile_x: int, min_tile_y: int, debug_mode: bool = False) -> List[dict]:
-        """Detect blue polygons in the map image and convert to GeoJSON (optimized)"""
+                           min_tile_x: int, min_tile_y: int, debug_mode: bool = False) -> PolygonCollection:
+        """Detect blue polygons in the map image and convert to lon/lat (optimized)"""
         print("Processing image for blue detection...")
         start_time = time.time()
         
@@ -177,7 +371,8 @@ class VillageMapCropper:
             cv2.drawContours(contour_image, contours, -1, (0, 255, 0), 2)
             cv2.imwrite('debug_contours.png', contour_image)
         
-        blue_polygons = []
+        rings = []
+        attributes = []
         
         for i, contour in enumerate(contours):
             area = cv2.contourArea(contour)
@@ -189,31 +384,14 @@ class VillageMapCropper:
             epsilon = 0.01 * cv2.arcLength(contour, True)
             simplified_contour = cv2.approxPolyDP(contour, epsilon, True)
             
-            # Convert to lat/lon
-            coordinates = []
-            for point in simplified_contour:
-                pixel_x, pixel_y = point[0][0], point[0][1]
-                lat, lon = self.pixel_to_latlon(pixel_x, pixel_y, zoom, min_tile_x, min_tile_y)
-                coordinates.append([lon, lat])
-            
-            if len(coordinates) > 2:
-                coordinates.append(coordinates[0])
-                
-                polygon_geojson = {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Polygon",
-                        "coordinates": [coordinates]
-                    },
-                    "properties": {
-                        "id": i + 1,
-                        "type": "blue_polygon",
-                        "area_pixels": int(area),
-                        "detected_from": "map_analysis",
-                        "coordinate_count": len(coordinates)
-                    }
-                }
-                blue_polygons.append(polygon_geojson)
+            if len(simplified_contour) > 2:
+                # Convert to lon/lat and close the ring
+                ring = self.pixels_to_lonlat(simplified_contour.reshape(-1, 2), zoom, min_tile_x, min_tile_y)
+                rings.append(np.vstack((ring, ring[:1])))
+                attributes.append((i + 1, int(area), False))
+        
+        blue_polygons = PolygonCollection.from_rings(
+            rings, np.array(attributes, dtype=PolygonCollection.ATTRIBUTE_DTYPE))
         
         processing_time = time.time() - start_time
         print(f"Blue polygon detection completed in {processing_time:.2f} seconds")
@@ -263,77 +441,79 @@ class VillageMapCropper:
         
         return inside
     
-    def polygon_intersects_village(self, blue_polygon_coords: List[List[float]], 
-                                 village_coords: List[List[float]]) -> bool:
+    def points_in_polygon(self, points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+        """Vectorized point_in_polygon: test (M, 2) points against an open (K, 2) ring"""
+        x = points[:, 0:1]
+        y = points[:, 1:2]
+        p1x, p1y = polygon[:, 0], polygon[:, 1]
+        p2 = np.roll(polygon, -1, axis=0)
+        p2x, p2y = p2[:, 0], p2[:, 1]
+        
+        # Same edge-crossing rule as point_in_polygon, evaluated for every point/edge pair
+        spans = (y > np.minimum(p1y, p2y)) & (y <= np.maximum(p1y, p2y)) & (x <= np.maximum(p1x, p2x))
+        dy = np.where(p1y != p2y, p2y - p1y, 1.0)
+        xinters = (y - p1y) * (p2x - p1x) / dy + p1x
+        crossings = spans & ((p1x == p2x) | (x <= xinters))
+        return crossings.sum(axis=1) % 2 == 1
+    
+    def polygon_intersects_village(self, blue_polygon_coords: np.ndarray, 
+                                 village_coords: np.ndarray) -> bool:
         """Check if blue polygon intersects with village boundary"""
-        # Convert to tuples for easier processing
-        village_poly = [(coord[0], coord[1]) for coord in village_coords[:-1]]  # Remove last duplicate point
-        blue_poly = [(coord[0], coord[1]) for coord in blue_polygon_coords[:-1]]  # Remove last duplicate point
+        village_poly = np.asarray(village_coords, dtype=np.float64)[:-1]  # Remove last duplicate point
+        blue_poly = np.asarray(blue_polygon_coords, dtype=np.float64)[:-1]  # Remove last duplicate point
         
         # Check if any vertex of blue polygon is inside village
-        for point in blue_poly:
-            if self.point_in_polygon(point, village_poly):
-                return True
+        if self.points_in_polygon(blue_poly, village_poly).any():
+            return True
         
         # Check if any vertex of village is inside blue polygon
-        for point in village_poly:
-            if self.point_in_polygon(point, blue_poly):
-                return True
+        if self.points_in_polygon(village_poly, blue_poly).any():
+            return True
         
         # Check if blue polygon center is inside village (additional safety check)
-        if blue_poly:
-            center_lon = sum(p[0] for p in blue_poly) / len(blue_poly)
-            center_lat = sum(p[1] for p in blue_poly) / len(blue_poly)
-            if self.point_in_polygon((center_lon, center_lat), village_poly):
+        if len(blue_poly):
+            center = blue_poly.mean(axis=0, keepdims=True)
+            if self.points_in_polygon(center, village_poly)[0]:
                 return True
         
         return False
     
-    def filter_blue_polygons_within_village(self, blue_polygons: List[dict], 
-                                          village_geojson: dict) -> List[dict]:
+    def filter_blue_polygons_within_village(self, blue_polygons: PolygonCollection, 
+                                          village_geojson: dict) -> PolygonCollection:
         """Filter blue polygons to only include those within village boundary (optimized)"""
-        if not blue_polygons:
-            return []
+        if not len(blue_polygons):
+            return blue_polygons
             
-        village_coords = village_geojson['geometry']['coordinates'][0]
-        filtered_polygons = []
+        village_coords = np.asarray(village_geojson['geometry']['coordinates'][0], dtype=np.float64)
         
         print(f"Filtering {len(blue_polygons)} blue polygons...")
         
-        # Pre-calculate village bounding box for quick elimination
-        village_lats = [coord[1] for coord in village_coords]
-        village_lons = [coord[0] for coord in village_coords]
-        village_min_lat, village_max_lat = min(village_lats), max(village_lats)
-        village_min_lon, village_max_lon = min(village_lons), max(village_lons)
+        # Quick bounding box check first: polygons whose center lies outside the
+        # village bbox are skipped without a detailed check
+        village_min = village_coords.min(axis=0)
+        village_max = village_coords.max(axis=0)
+        centers = blue_polygons.exterior_means()
+        in_bbox = np.all((centers >= village_min) & (centers <= village_max), axis=1)
         
-        for i, polygon in enumerate(blue_polygons):
-            blue_coords = polygon['geometry']['coordinates'][0]
-            
-            # Quick bounding box check first
-            blue_lats = [coord[1] for coord in blue_coords]
-            blue_lons = [coord[0] for coord in blue_coords]
-            blue_center_lat = sum(blue_lats) / len(blue_lats)
-            blue_center_lon = sum(blue_lons) / len(blue_lons)
-            
-            # Quick elimination: if center is completely outside village bbox, skip detailed check
-            if (blue_center_lat < village_min_lat or blue_center_lat > village_max_lat or
-                blue_center_lon < village_min_lon or blue_center_lon > village_max_lon):
+        keep = []
+        for i in range(len(blue_polygons)):
+            if not in_bbox[i]:
                 print(f"✗ Blue polygon {i+1}: OUTSIDE village boundary (quick check)")
                 continue
             
             # Detailed intersection check only for polygons that pass bbox test
-            is_within = self.polygon_intersects_village(blue_coords, village_coords)
-            
-            if is_within:
-                polygon['properties']['within_village'] = True
-                filtered_polygons.append(polygon)
+            if self.polygon_intersects_village(blue_polygons.exterior(i), village_coords):
+                keep.append(i)
                 print(f"✓ Blue polygon {i+1}: INSIDE village boundary")
             else:
                 print(f"✗ Blue polygon {i+1}: OUTSIDE village boundary")
         
+        filtered_polygons = blue_polygons.take(keep)
+        filtered_polygons.attributes['within_village'] = True
+        
         print(f"Filtered result: {len(filtered_polygons)} blue polygons within village boundary")
         return filtered_polygons
-    def compare_with_village_boundary(self, blue_polygons: List[dict], 
+    def compare_with_village_boundary(self, blue_polygons: PolygonCollection, 
                                     village_geojson: dict) -> dict:
         """Compare detected blue polygons with village boundary (all should be within now)"""
         village_coords = village_geojson['geometry']['coordinates'][0]
@@ -343,6 +523,12 @@ class VillageMapCropper:
         village_lons = [coord[0] for coord in village_coords]
         village_bbox_area = (max(village_lats) - min(village_lats)) * (max(village_lons) - min(village_lons))
         
+        # Calculate blue polygon centers and bbox areas for all polygons at once
+        centers = blue_polygons.exterior_means()
+        mins, maxs = blue_polygons.exterior_bounds()
+        spans = maxs - mins
+        blue_areas = spans[:, 0] * spans[:, 1]
+        
         comparison_results = {
             "village_info": {
                 "name": village_geojson.get('properties', {}).get('name', 'Unknown'),
@@ -355,42 +541,22 @@ class VillageMapCropper:
                 "polygons_within_village": len(blue_polygons),  # All should be within now
                 "polygons_outside_village": 0,  # Should be 0 after filtering
                 "polygons_overlapping": 0,
-                "total_blue_area": 0.0
+                "total_blue_area": float(blue_areas.sum())
             }
         }
         
-        total_area = 0.0
-        
-        for i, polygon in enumerate(blue_polygons):
-            blue_coords = polygon['geometry']['coordinates'][0]
-            blue_lats = [coord[1] for coord in blue_coords]
-            blue_lons = [coord[0] for coord in blue_coords]
-            
-            # Calculate blue polygon center and area
-            blue_center_lat = sum(blue_lats) / len(blue_lats)
-            blue_center_lon = sum(blue_lons) / len(blue_lons)
-            blue_area = (max(blue_lats) - min(blue_lats)) * (max(blue_lons) - min(blue_lons))
-            total_area += blue_area
-            
+        for i in range(len(blue_polygons)):
             polygon_info = {
                 "id": i + 1,
                 "relationship_to_village": "within",  # All should be within after filtering
-                "center_coordinates": [blue_center_lon, blue_center_lat],
-                "bbox_area": blue_area,
-                "area_pixels": polygon['properties'].get('area_pixels', 0),
-                "geojson": polygon
+                "center_coordinates": centers[i].tolist(),
+                "bbox_area": float(blue_areas[i]),
+                "area_pixels": int(blue_polygons.attributes['area_pixels'][i])
             }
             
             comparison_results["blue_polygons"].append(polygon_info)
         
-        comparison_results["analysis"]["total_blue_area"] = total_area
-        
         return comparison_results
-        """Create a mask from polygon coordinates"""
-        mask = Image.new('L', image_size, 0)
-        draw = ImageDraw.Draw(mask)
-        draw.polygon(polygon_pixels, fill=255)
-        return mask
     
     def create_polygon_mask(self, image_size: Tuple[int, int], 
                            polygon_pixels: List[Tuple[int, int]]) -> Image.Image:
@@ -400,7 +566,7 @@ class VillageMapCropper:
         draw.polygon(polygon_pixels, fill=255)
         return mask
     
-    def crop_map_to_village(self, geojson_file: str, zoom: int = 15) -> Tuple[Image.Image, dict, dict, int, int]:
+    def crop_map_to_village(self, geojson_file: str, zoom: int = 15) -> Tuple[Image.Image, PolygonCollection, dict, int, int]:
         """Main function to crop map to village boundary and detect blue polygons"""
         """Main function to crop map to village boundary"""
         # Load GeoJSON
@@ -523,93 +689,217 @@ class VillageMapCropper:
         return result, blue_polygons, comparison_results, min_tile_x, min_tile_y
     
     def save_village_map_with_analysis(self, geojson_file: str, output_file: str = "village_map.png", 
-                                     zoom: int = 15):
-        """Save the cropped village map and analyze blue polygons (optimized)"""
+                                     zoom: int = 15,
+                                     polygons_file: str = "blue_polygons_within_village.geojson",
+                                     analysis_file: str = "blue_polygons_within_village_analysis.json"):
+        """Save the cropped village map and analyze blue polygons (optimized).
+        
+        Returns (output_file, blue_polygons, comparison_results), where blue_polygons
+        is a list of GeoJSON Feature dicts and comparison_results is the analysis
+        dict written to analysis_file. On error, returns (None, [], {}).
+        """
+        try:
+            return self._save_village_map_with_analysis(geojson_file, output_file, zoom,
+                                                        polygons_file, analysis_file)
+        except Exception as e:
+            print(f"Error creating village map with analysis: {e}")
+            return None, [], {}
+    
+    def _save_village_map_with_analysis(self, geojson_file: str, output_file: str, zoom: int,
+                                        polygons_file: str, analysis_file: str):
+        """Same as save_village_map_with_analysis, but lets errors propagate to the caller"""
         overall_start = time.time()
         
-        try:
-            result, blue_polygons, comparison_results, min_tile_x, min_tile_y = self.crop_map_to_village(geojson_file, zoom)
-            
-            # Save the cropped village map
-            print("Saving village map...")
-            result.save(output_file, 'PNG')
-            print(f"Village map saved as {output_file}")
+        result, polygon_collection, comparison_results, min_tile_x, min_tile_y = self.crop_map_to_village(geojson_file, zoom)
+        
+        # GeoJSON is only built here, when the polygons are written out
+        blue_polygons = polygon_collection.to_geojson({"type": "blue_polygon", "detected_from": "map_analysis"})
+        
+        # Save the cropped village map
+        print("Saving village map...")
+        result.save(output_file, 'PNG')
+        print(f"Village map saved as {output_file}")
+        
+        # Save results efficiently
+        if blue_polygons:
+            print("Saving blue polygon results...")
             
-            # Save results efficiently
-            if blue_polygons:
-                print("Saving blue polygon results...")
-                
-                # Save all blue polygons as one GeoJSON collection
-                blue_collection = {
-                    "type": "FeatureCollection",
-                    "features": blue_polygons,
-                    "properties": {
-                        "source": "detected_from_map_within_village",
-                        "total_polygons": len(blue_polygons),
-                        "detection_zoom_level": zoom,
-                        "filtered": "only_within_village_boundary"
-                    }
+            # Save all blue polygons as one GeoJSON collection
+            blue_collection = {
+                "type": "FeatureCollection",
+                "features": blue_polygons,
+                "properties": {
+                    "source": "detected_from_map_within_village",
+                    "total_polygons": len(blue_polygons),
+                    "detection_zoom_level": zoom,
+                    "filtered": "only_within_village_boundary"
                 }
-                
-                with open('blue_polygons_within_village.geojson', 'w') as f:
-                    json.dump(blue_collection, f, indent=2)
-                
-                # Save individual polygons (optional - can be disabled for speed)
-                # for i, polygon in enumerate(blue_polygons):
-                #     filename = f'blue_polygon_within_village_{i+1}.geojson'
-                #     with open(filename, 'w') as f:
-                #         json.dump(polygon, f, indent=2)
-                
-                print(f"Saved {len(blue_polygons)} blue polygons to 'blue_polygons_within_village.geojson'")
-            else:
-                print("No blue polygons found within the village boundary.")
-            
-            # Save comparison analysis
-            with open('blue_polygons_within_village_analysis.json', 'w') as f:
-                json.dump(comparison_results, f, indent=2)
-            
-            overall_time = time.time() - overall_start
-            
-            # Print optimized summary
-            print(f"\n=== COMPLETED IN {overall_time:.2f} SECONDS ===")
-            print(f"Village: {comparison_results['village_info']['name']}")
-            print(f"Blue polygons found within village: {comparison_results['blue_polygons_count']}")
+            }
             
-            if comparison_results['blue_polygons_count'] > 0:
-                print(f"Total blue area: {comparison_results['analysis']['total_blue_area']:.8f}")
-                print("✓ Files generated:")
-                print(f"  - {output_file}")
-                print("  - blue_polygons_within_village.geojson")
-                print("  - blue_polygons_within_village_analysis.json")
+            with open(polygons_file, 'w') as f:
+                json.dump(blue_collection, f, indent=2)
             
-            return output_file, blue_polygons, comparison_results
+            print(f"Saved {len(blue_polygons)} blue polygons to '{polygons_file}'")
+        else:
+            print("No blue polygons found within the village boundary.")
+        
+        # Attach each polygon's GeoJSON to its analysis entry, as consumers of the
+        # analysis file expect
+        for polygon_info, feature in zip(comparison_results["blue_polygons"], blue_polygons):
+            polygon_info["geojson"] = feature
+        
+        # Save comparison analysis
+        with open(analysis_file, 'w') as f:
+            json.dump(comparison_results, f, indent=2)
+        
+        overall_time = time.time() - overall_start
+        
+        # Print optimized summary
+        print(f"\n=== COMPLETED IN {overall_time:.2f} SECONDS ===")
+        print(f"Village: {comparison_results['village_info']['name']}")
+        print(f"Blue polygons found within village: {comparison_results['blue_polygons_count']}")
+        
+        if comparison_results['blue_polygons_count'] > 0:
+            print(f"Total blue area: {comparison_results['analysis']['total_blue_area']:.8f}")
+            print("✓ Files generated:")
+            print(f"  - {output_file}")
+            print(f"  - {polygons_file}")
+            print(f"  - {analysis_file}")
+        
+        return output_file, blue_polygons, comparison_results
+    
+    def run_batch(self, geojson_files: List[str], output_dir: str = "village_maps",
+                  zoom: int = 15, manifest_file: str = None, max_attempts: int = 3) -> dict:
+        """Process many villages, recording progress in a resumable job manifest.
+        
+        Villages already completed with the same inputs and whose outputs still
+        exist are skipped, and failed ones (including tile download errors) are
+        retried until they have used up max_attempts across all runs.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        if manifest_file is None:
+            manifest_file = os.path.join(output_dir, "manifest.sqlite")
+        manifest = JobManifest(manifest_file)
+        
+        # Tile download errors must fail the village so it gets retried,
+        # rather than saving a map with blank tiles
+        previous_strict = self.strict_downloads
+        self.strict_downloads = True
+        try:
+            summary = self._run_batch(manifest, geojson_files, output_dir, zoom, max_attempts)
+        finally:
+            self.strict_downloads = previous_strict
+            manifest.close()
+        
+        summary["manifest"] = manifest_file
+        return summary
+    
+    def _village_names(self, geojson_files: List[str]) -> List[Tuple[str, str]]:
+        """Return (manifest key, output name) for each village file.
+        
+        The key is the normalized absolute path. The output name is the file
+        name plus a short hash of that key, so it depends only on the village
+        itself and same-named villages in different folders don't clash.
+        """
+        names = []
+        for geojson_file in geojson_files:
+            path = os.path.abspath(geojson_file)
+            village_id = os.path.normcase(path)
+            stem = os.path.splitext(os.path.basename(path))[0]
+            path_hash = hashlib.sha256(village_id.encode()).hexdigest()[:8]
+            names.append((village_id, f"{stem}_{path_hash}"))
+        return names
+    
+    def _run_batch(self, manifest: JobManifest, geojson_files: List[str], output_dir: str,
+                   zoom: int, max_attempts: int) -> dict:
+        """Body of run_batch, working against an open manifest"""
+        # Work out which villages still need processing before starting
+        pending = []
+        skipped_done = skipped_failed = unreadable = 0
+        for geojson_file, (village_id, output_name) in zip(geojson_files, self._village_names(geojson_files)):
+            try:
+                inputs_hash = JobManifest.hash_inputs(geojson_file, zoom)
+            except OSError as e:
+                print(f"Skipping {geojson_file}: cannot read boundary file: {e}")
+                manifest.start(village_id, geojson_file, '')
+                manifest.finish(village_id, 'failed', 0.0, error=repr(e))
+                unreadable += 1
+                continue
             
-        except Exception as e:
-            print(f"Error creating village map with analysis: {e}")
-            return None, [], {}, f"Polygons found within village: {comparison_results['blue_polygons_count']}"
-
-            #return None, [], {}ons found within village: {comparison_results['blue_polygons_count']}")
-            print(f"Total blue area within village: {comparison_results['analysis']['total_blue_area']:.8f}")
+            job = manifest.get(village_id)
+            if job and job['inputs_hash'] == inputs_hash:
+                if job['status'] == 'done':
+                    outputs = json.loads(job['outputs'] or '{}')
+                    if all(os.path.exists(path) for path in outputs.values()):
+                        skipped_done += 1
+                        continue
+                    # Outputs were deleted since the last run, so start over
+                    print(f"Reprocessing {village_id}: output files are missing")
+                    manifest.reset(village_id)
+                elif job['attempts'] >= max_attempts:
+                    print(f"Skipping {village_id}: failed {job['attempts']} times, last error: {job['error']}")
+                    skipped_failed += 1
+                    continue
+            elif job:
+                # Inputs changed since the last run, so start over
+                manifest.reset(village_id)
             
-            if comparison_results['blue_polygons_count'] > 0:
-                print("\nBlue polygon details (all within village boundary):")
-                for poly in comparison_results['blue_polygons']:
-                    print(f"  Polygon {poly['id']}:")
-                    print(f"    Center: {poly['center_coordinates']}")
-                    print(f"    Area: {poly['bbox_area']:.8f}")
-                    print(f"    Pixel area: {poly['area_pixels']} pixels")
-            else:
-                print("\nNo blue polygons found within the village boundary.")
-                print("This could mean:")
-                print("  - No water bodies/rivers within village limits")
-                print("  - Blue features too small to detect")
-                print("  - Different blue color shade than expected")
+            pending.append((village_id, output_name, geojson_file, inputs_hash))
+        
+        print(f"Batch: {len(geojson_files)} villages, {skipped_done} already done, "
+              f"{skipped_failed} gave up, {unreadable} unreadable, {len(pending)} to process")
+        
+        batch_start = time.time()
+        succeeded = failed = 0
+        
+        for completed, (village_id, output_name, geojson_file, inputs_hash) in enumerate(pending, start=1):
+            base = os.path.join(output_dir, output_name)
+            outputs = {
+                "map": base + ".png",
+                "polygons": base + "_blue_polygons.geojson",
+                "analysis": base + "_analysis.json"
+            }
             
-            return output_file, blue_polygons, comparison_results
+            while True:
+                attempts = manifest.start(village_id, geojson_file, inputs_hash)
+                job_start = time.time()
+                try:
+                    _, blue_polygons, _ = self._save_village_map_with_analysis(
+                        geojson_file, outputs["map"], zoom, outputs["polygons"], outputs["analysis"])
+                except Exception as e:
+                    manifest.finish(village_id, 'failed', time.time() - job_start, error=repr(e))
+                    print(f"Error processing {village_id} (attempt {attempts}/{max_attempts}): {e}")
+                    if attempts >= max_attempts:
+                        failed += 1
+                        break
+                    time.sleep(min(2 ** attempts, 30))  # Back off before retrying
+                else:
+                    # The polygons file is only written when polygons were found
+                    written = {name: path for name, path in outputs.items()
+                               if name != "polygons" or blue_polygons}
+                    manifest.finish(village_id, 'done', time.time() - job_start, outputs=written)
+                    succeeded += 1
+                    break
             
-        except Exception as e:
-            print(f"Error creating village map with analysis: {e}")
-            return None, [], {}
+            # Progress and ETA based on the average time per village in this run
+            elapsed = time.time() - batch_start
+            remaining = len(pending) - completed
+            eta = elapsed / completed * remaining
+            progress = (completed / len(pending)) * 100
+            print(f"Batch progress: {progress:.1f}% ({completed}/{len(pending)}), "
+                  f"elapsed {elapsed:.0f}s, ETA {eta:.0f}s")
+        
+        print(f"\n=== BATCH COMPLETED IN {time.time() - batch_start:.2f} SECONDS ===")
+        print(f"Succeeded: {succeeded}, failed: {failed + unreadable}, "
+              f"skipped: {skipped_done + skipped_failed}")
+        return {
+            "total": len(geojson_files),
+            "skipped_done": skipped_done,
+            "skipped_failed": skipped_failed,
+            "unreadable": unreadable,
+            "succeeded": succeeded,
+            "failed": failed
+        }
     
     def save_village_map(self, geojson_file: str, output_file: str = "village_map.png", zoom: int = 15):
         """Legacy method for backward compatibility"""
@@ -668,6 +958,13 @@ if __name__ == "__main__":
         print(f"Success! Village map saved as {output_file}")
     else:
         print("Failed to generate village map")
+    
+    # For state-wide runs, process a whole folder of villages. Progress is kept in
+    # village_maps/manifest.sqlite, so rerunning after a crash skips finished villages
+    # and retries failed ones (up to max_attempts).
+    # import glob
+    # village_files = sorted(glob.glob(r"D:\selected_maps_for_SIH\splitted_villages\*.geojson"))
+    # cropper.run_batch(village_files, output_dir='village_maps', zoom=16, max_attempts=3)
 
 # HOW TO USE:
 # 1. Save your village boundary as a .geojson file
@@ -0,0 +1,357 @@
+import contextlib
+import io
+import json
+import os
+
+import pytest
+
+for module in ("cv2", "numpy", "PIL", "requests", "sklearn"):
+    pytest.importorskip(module)
+
+import numpy as np
+
+import fast_find
+from fast_find import JobManifest, PolygonCollection, VillageMapCropper
+
+
+class FakeCropper(VillageMapCropper):
+    """Cropper whose per-village work is stubbed out, for testing batch bookkeeping"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.failing = set()
+        self.polygons = [{"type": "Feature"}]
+
+    def _save_village_map_with_analysis(self, geojson_file, output_file, zoom,
+                                        polygons_file, analysis_file):
+        self.calls.append(os.path.basename(geojson_file))
+        if os.path.basename(geojson_file) in self.failing:
+            raise ValueError("boom")
+        with open(output_file, 'w') as f:
+            f.write(geojson_file)
+        if self.polygons:
+            with open(polygons_file, 'w') as f:
+                json.dump(self.polygons, f)
+        with open(analysis_file, 'w') as f:
+            json.dump({}, f)
+        return output_file, self.polygons, {}
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(fast_find.time, "sleep", lambda seconds: None)
+
+
+@pytest.fixture
+def villages(tmp_path):
+    paths = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / "villages" / f"{name}.geojson"
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(json.dumps({"name": name}))
+        paths.append(str(path))
+    return paths
+
+
+def run(cropper, files, tmp_path, **kwargs):
+    return cropper.run_batch(files, output_dir=str(tmp_path / "out"), **kwargs)
+
+
+def job_for(tmp_path, geojson_file):
+    manifest = JobManifest(str(tmp_path / "out" / "manifest.sqlite"))
+    job = manifest.get(os.path.normcase(os.path.abspath(geojson_file)))
+    manifest.close()
+    return job
+
+
+def test_done_villages_are_skipped(villages, tmp_path):
+    cropper = FakeCropper()
+    summary = run(cropper, villages, tmp_path)
+    assert summary["succeeded"] == 3
+
+    cropper.calls.clear()
+    summary = run(cropper, villages, tmp_path)
+    assert cropper.calls == []
+    assert summary["skipped_done"] == 3
+
+
+def test_failed_villages_retry_across_runs_until_max_attempts(villages, tmp_path):
+    cropper = FakeCropper()
+    cropper.failing = {"b.geojson"}
+
+    summary = run(cropper, villages, tmp_path, max_attempts=2)
+    assert cropper.calls.count("b.geojson") == 2
+    assert summary["failed"] == 1
+
+    cropper.calls.clear()
+    summary = run(cropper, villages, tmp_path, max_attempts=3)
+    assert cropper.calls == ["b.geojson"]
+
+    cropper.calls.clear()
+    summary = run(cropper, villages, tmp_path, max_attempts=3)
+    assert cropper.calls == []
+    assert summary["skipped_failed"] == 1
+
+    job = job_for(tmp_path, villages[1])
+    assert job["status"] == "failed"
+    assert job["attempts"] == 3
+    assert "boom" in job["error"]
+
+
+def test_changed_inputs_reset_the_village(villages, tmp_path):
+    cropper = FakeCropper()
+    cropper.failing = {"a.geojson"}
+    run(cropper, villages, tmp_path, max_attempts=1)
+
+    with open(villages[0], 'w') as f:
+        json.dump({"name": "a", "fixed": True}, f)
+    cropper.failing = set()
+    cropper.calls.clear()
+    summary = run(cropper, villages, tmp_path, max_attempts=1)
+    assert cropper.calls == ["a.geojson"]
+    assert summary["succeeded"] == 1
+
+
+def test_missing_outputs_are_reprocessed(villages, tmp_path):
+    cropper = FakeCropper()
+    run(cropper, villages, tmp_path)
+
+    os.remove(json.loads(job_for(tmp_path, villages[0])["outputs"])["map"])
+    cropper.calls.clear()
+    run(cropper, villages, tmp_path)
+    assert cropper.calls == ["a.geojson"]
+
+
+def test_only_written_outputs_are_recorded(villages, tmp_path):
+    cropper = FakeCropper()
+    cropper.polygons = []
+    run(cropper, villages[:1], tmp_path)
+
+    job = job_for(tmp_path, villages[0])
+    assert set(json.loads(job["outputs"])) == {"map", "analysis"}
+
+    cropper.calls.clear()
+    run(cropper, villages[:1], tmp_path)
+    assert cropper.calls == []
+
+
+def test_unreadable_file_does_not_abort_batch(villages, tmp_path):
+    cropper = FakeCropper()
+    missing = str(tmp_path / "villages" / "missing.geojson")
+    summary = run(cropper, [missing] + villages, tmp_path)
+    assert summary["unreadable"] == 1
+    assert summary["succeeded"] == 3
+
+
+@pytest.fixture
+def same_named_villages(tmp_path):
+    files = []
+    for district in ("north", "south"):
+        path = tmp_path / district / "Village Name.geojson"
+        path.parent.mkdir()
+        path.write_text(json.dumps({"district": district}))
+        files.append(str(path))
+    return files
+
+
+def test_same_file_name_in_different_folders(same_named_villages, tmp_path):
+    cropper = FakeCropper()
+    summary = run(cropper, same_named_villages, tmp_path)
+    assert summary["succeeded"] == 2
+
+    maps = [json.loads(job_for(tmp_path, f)["outputs"])["map"] for f in same_named_villages]
+    assert maps[0] != maps[1]
+    # Output names keep the original file name, including its case
+    assert all(os.path.basename(m).startswith("Village Name_") for m in maps)
+
+    cropper.calls.clear()
+    run(cropper, same_named_villages, tmp_path)
+    assert cropper.calls == []
+
+
+def test_output_names_do_not_depend_on_other_files_in_batch(same_named_villages, tmp_path):
+    cropper = FakeCropper()
+    north, south = same_named_villages
+    run(cropper, [north], tmp_path)
+    run(cropper, [south], tmp_path)
+
+    for geojson_file in same_named_villages:
+        with open(json.loads(job_for(tmp_path, geojson_file)["outputs"])["map"]) as f:
+            assert f.read() == geojson_file
+
+    cropper.calls.clear()
+    summary = run(cropper, same_named_villages, tmp_path)
+    assert cropper.calls == []
+    assert summary["skipped_done"] == 2
+
+
+def test_strict_downloads_raise_tile_errors(monkeypatch):
+    cropper = VillageMapCropper(strict_downloads=True)
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("network blip")
+
+    monkeypatch.setattr(cropper.session, "get", fail)
+    with pytest.raises(ConnectionError):
+        cropper.download_tile(0, 0, 1)
+
+
+def make_collection(polygons):
+    """Build a PolygonCollection from a list of polygons, each a list of closed rings"""
+    rings = [np.array(ring, dtype=np.float64) for polygon in polygons for ring in polygon]
+    ring_offsets = np.concatenate(([0], np.cumsum([len(ring) for ring in rings])))
+    geom_offsets = np.concatenate(([0], np.cumsum([len(polygon) for polygon in polygons])))
+    attributes = np.array([(i + 1, 100 * (i + 1), False) for i in range(len(polygons))],
+                          dtype=PolygonCollection.ATTRIBUTE_DTYPE)
+    coords = np.concatenate(rings) if rings else np.zeros((0, 2))
+    return PolygonCollection(coords, ring_offsets, geom_offsets, attributes)
+
+
+SQUARE = [[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]
+HOLE = [[1, 1], [2, 1], [2, 2], [1, 1]]
+TRIANGLE = [[10, 10], [12, 10], [11, 13], [10, 10]]
+
+
+def test_points_in_polygon_matches_point_in_polygon():
+    cropper = VillageMapCropper()
+    # Concave ring with horizontal and vertical edges
+    polygon = [(0, 0), (4, 0), (4, 3), (2, 1), (1, 3), (0, 3)]
+    grid = [(x / 2, y / 2) for x in range(-2, 11) for y in range(-2, 9)]
+
+    expected = [cropper.point_in_polygon(point, polygon) for point in grid]
+    actual = cropper.points_in_polygon(np.array(grid, dtype=np.float64), np.array(polygon, dtype=np.float64))
+    assert actual.tolist() == expected
+
+
+def test_take_rebuilds_offsets_for_multi_ring_polygons():
+    collection = make_collection([[TRIANGLE], [SQUARE, HOLE], [TRIANGLE]])
+    subset = collection.take([1, 2])
+
+    assert len(subset) == 2
+    assert subset.geom_offsets.tolist() == [0, 2, 3]
+    assert subset.ring_offsets.tolist() == [0, 5, 9, 13]
+    assert subset.attributes['id'].tolist() == [2, 3]
+    assert subset.to_geojson()[0]["geometry"]["coordinates"] == [SQUARE, HOLE]
+    assert subset.exterior(1).tolist() == TRIANGLE
+
+
+def test_take_empty_selection():
+    subset = make_collection([[SQUARE, HOLE], [TRIANGLE]]).take([])
+
+    assert len(subset) == 0
+    assert subset.coords.shape == (0, 2)
+    assert subset.ring_offsets.tolist() == [0]
+    assert subset.geom_offsets.tolist() == [0]
+    assert subset.exterior_means().shape == (0, 2)
+    assert subset.to_geojson() == []
+
+
+def test_exterior_bounds_and_means_ignore_holes():
+    collection = make_collection([[SQUARE, HOLE], [TRIANGLE]])
+    mins, maxs = collection.exterior_bounds()
+
+    assert mins.tolist() == [[0, 0], [10, 10]]
+    assert maxs.tolist() == [[4, 4], [12, 13]]
+    assert collection.exterior_means() == pytest.approx(
+        np.array([np.mean(SQUARE, axis=0), np.mean(TRIANGLE, axis=0)]))
+
+
+def test_concat_ranges():
+    ranges = fast_find._concat_ranges(np.array([5, 0, 9]), np.array([2, 0, 3]))
+    assert ranges.tolist() == [5, 6, 9, 10, 11]
+
+
+def test_pixels_to_lonlat_matches_pixel_to_latlon():
+    cropper = VillageMapCropper()
+    pixels = np.array([[0, 0], [10, 20], [300, 511]], dtype=np.int32)
+
+    lonlat = cropper.pixels_to_lonlat(pixels, 16, 46000, 30000)
+    for (pixel_x, pixel_y), (lon, lat) in zip(pixels.tolist(), lonlat):
+        expected_lat, expected_lon = cropper.pixel_to_latlon(pixel_x, pixel_y, 16, 46000, 30000)
+        assert lon == pytest.approx(expected_lon, abs=1e-12)
+        assert lat == pytest.approx(expected_lat, abs=1e-12)
+
+
+def reference_analysis(cropper, blue_polygons, village_geojson):
+    """The list-of-dicts filter and compare logic the columnar pipeline replaced"""
+    village_coords = village_geojson['geometry']['coordinates'][0]
+    village_lats = [coord[1] for coord in village_coords]
+    village_lons = [coord[0] for coord in village_coords]
+
+    filtered = []
+    for polygon in blue_polygons:
+        blue_coords = polygon['geometry']['coordinates'][0]
+        center_lat = sum(coord[1] for coord in blue_coords) / len(blue_coords)
+        center_lon = sum(coord[0] for coord in blue_coords) / len(blue_coords)
+        if not (min(village_lats) <= center_lat <= max(village_lats) and
+                min(village_lons) <= center_lon <= max(village_lons)):
+            continue
+        village_poly = [tuple(coord) for coord in village_coords[:-1]]
+        blue_poly = [tuple(coord) for coord in blue_coords[:-1]]
+        center = (sum(p[0] for p in blue_poly) / len(blue_poly), sum(p[1] for p in blue_poly) / len(blue_poly))
+        if (any(cropper.point_in_polygon(p, village_poly) for p in blue_poly) or
+                any(cropper.point_in_polygon(p, blue_poly) for p in village_poly) or
+                cropper.point_in_polygon(center, village_poly)):
+            polygon['properties']['within_village'] = True
+            filtered.append(polygon)
+
+    entries = []
+    for i, polygon in enumerate(filtered):
+        blue_coords = polygon['geometry']['coordinates'][0]
+        lats = [coord[1] for coord in blue_coords]
+        lons = [coord[0] for coord in blue_coords]
+        entries.append({
+            "id": i + 1,
+            "relationship_to_village": "within",
+            "center_coordinates": [sum(lons) / len(lons), sum(lats) / len(lats)],
+            "bbox_area": (max(lats) - min(lats)) * (max(lons) - min(lons)),
+            "area_pixels": polygon['properties']['area_pixels'],
+            "geojson": polygon
+        })
+    return entries
+
+
+class FakeImage:
+    def save(self, path, fmt):
+        with open(path, 'w') as f:
+            f.write("png")
+
+
+def test_filter_and_compare_match_list_of_dicts_reference(tmp_path):
+    cropper = VillageMapCropper()
+    village = {
+        "type": "Feature",
+        "geometry": {"type": "Polygon", "coordinates": [[[0, 0], [6, 0], [6, 6], [3, 2], [0, 6], [0, 0]]]},
+        "properties": {"name": "Test Village"}
+    }
+    polygons = [
+        [[[1, 1], [2, 1], [2, 1.5], [1, 1]]],              # inside
+        [[[20, 20], [21, 20], [21, 21], [20, 20]]],        # far outside
+        [[[2.5, 4], [3.5, 4], [3.5, 5], [2.5, 4]]],        # in the notch, outside
+        [[[5, 5], [7, 5], [7, 7], [5, 7], [5, 5]]],        # overlapping the edge
+        [[[-1, 1], [7, 1], [7, 1.2], [-1, 1.2], [-1, 1]]]    # crossing, only its center inside
+    ]
+    collection = make_collection(polygons)
+    static = {"type": "blue_polygon", "detected_from": "map_analysis"}
+    expected = reference_analysis(cropper, collection.to_geojson(static), village)
+
+    def crop_map_to_village(geojson_file, zoom):
+        with contextlib.redirect_stdout(io.StringIO()):
+            filtered = cropper.filter_blue_polygons_within_village(collection, village)
+        return FakeImage(), filtered, cropper.compare_with_village_boundary(filtered, village), 0, 0
+
+    cropper.crop_map_to_village = crop_map_to_village
+    analysis_file = str(tmp_path / "analysis.json")
+    cropper._save_village_map_with_analysis("village.geojson", str(tmp_path / "map.png"), 15,
+                                            str(tmp_path / "polygons.geojson"), analysis_file)
+    with open(analysis_file) as f:
+        actual = json.load(f)["blue_polygons"]
+
+    assert [entry["geojson"]["properties"]["id"] for entry in actual] == [1, 4, 5]
+    assert len(actual) == len(expected)
+    for got, want in zip(actual, expected):
+        # Centers and areas may differ in the last bits from the old pure-Python sums
+        assert got.pop("center_coordinates") == pytest.approx(want.pop("center_coordinates"))
+        assert got.pop("bbox_area") == pytest.approx(want.pop("bbox_area"))
+        assert got == want